@@ -0,0 +1,175 @@
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import weather_features as wf
+
+
+class Hospital:
+    def __init__(self, name, long, lat):
+        self.name, self.long, self.lat = name, long, lat
+
+HOBART = Hospital("Royal Hobart Hospital", 147.3, -42.9)
+LAUNCESTON = Hospital("Launceston General Hospital", 147.1, -41.4)
+
+
+class Station:
+    #Just the attributes of weather_stations.Station that the store reads
+    def __init__(self, station_id, long, lat, start, end, precip=True, offset=0.0):
+        self.station_id, self.name, self.long, self.lat = station_id, str(station_id), long, lat
+        self.start, self.end = start, end
+        index = pd.date_range(pd.Timestamp(start, tz=wf.TIMEZONE),
+                              pd.Timestamp(end, tz=wf.TIMEZONE), freq="h", inclusive="left")
+        day = index.dayofyear.to_numpy()
+        air_temp = 10 + 5 * np.cos(2 * np.pi * (day - 15) / 365.25) + offset
+        air_temp = air_temp + np.sin(2 * np.pi * index.hour.to_numpy() / 24)
+        self.data = pd.DataFrame({"air_temp": air_temp,
+                                  "precipitation": 0.1 if precip else np.nan},
+                                 index=index)
+
+
+@pytest.fixture(autouse=True)
+def hospitals(monkeypatch):
+    #The real module geocodes the hospitals over the network on import
+    module = types.ModuleType("hospital_geospacial")
+    module.HOSPITALS = (HOBART, LAUNCESTON)
+    module.get_nearest_hospital = lambda long, lat: min(
+        module.HOSPITALS, key=lambda h: (h.long - long)**2 + (h.lat - lat)**2)
+    monkeypatch.setitem(sys.modules, "hospital_geospacial", module)
+
+@pytest.fixture
+def store():
+    store = wf.FeatureStore(":memory:")
+    yield store
+    store.close()
+
+
+def observed_frame(dates, values):
+    frame = pd.DataFrame({c: np.nan for c in wf.OBSERVED}, index=pd.DatetimeIndex(dates))
+    frame["obs_temp_max"] = values
+    return frame
+
+def test_fit_needs_a_year_of_history():
+    dates = pd.date_range("2016-01-01", periods=300)
+    assert wf.fit_seasonal_model(observed_frame(dates, 1.0), "temp_max") is None
+    #A year spanned, but by too few observations
+    sparse = pd.date_range("2016-01-01", periods=40, freq="10D")
+    assert wf.fit_seasonal_model(observed_frame(sparse, 1.0), "temp_max") is None
+    #Never observed
+    assert wf.fit_seasonal_model(observed_frame(dates, 1.0), "precip") is None
+
+def test_fit_leaves_out_trend_until_several_years():
+    dates = pd.date_range("2016-01-01", periods=2 * 365)
+    season = wf._design(dates, dates[0]).season
+    origin, params = wf.fit_seasonal_model(observed_frame(dates, 10 + 5 * season), "temp_max")
+    assert origin == dates[0]
+    assert params["time"] == 0
+    assert params["Intercept"] == pytest.approx(10)
+    assert params["season"] == pytest.approx(5)
+
+    dates = pd.date_range("2016-01-01", periods=4 * 365)
+    x = wf._design(dates, dates[0])
+    _, params = wf.fit_seasonal_model(observed_frame(dates, 10 + 0.5 * x.time + 5 * x.season),
+                                      "temp_max")
+    assert params["time"] == pytest.approx(0.5)
+
+def test_derive_features_lags_calendar_days():
+    dates = pd.to_datetime(["2016-07-01", "2016-07-02", "2016-07-04"])
+    derived = wf.derive_features(observed_frame(dates, [1.0, 2.0, 4.0]), {})
+    assert derived.index.tolist() == list(pd.date_range("2016-07-01", "2016-07-04"))
+    assert np.isnan(derived.obs_temp_max_lag1["2016-07-04"])
+    assert derived.obs_temp_max_lag2["2016-07-04"] == 2.0
+    #No model, so nothing expected
+    assert derived[wf.EXPECTED + wf.ANOMALY].isna().all().all()
+
+def test_station_daily_buckets_by_hobart_day():
+    station = Station(1, 147.3, -42.9, "2016-07-01", "2016-07-03")
+    daily = wf.station_daily([station])
+    assert daily.index.get_level_values("date").tolist() == list(
+        pd.to_datetime(["2016-07-01", "2016-07-02"]))
+    assert (daily.hospital == HOBART.name).all()
+    assert daily.obs_precip.tolist() == pytest.approx([2.4, 2.4])
+
+def test_station_daily_skips_distant_stations():
+    casey = Station(300017, 110.5, -66.3, "2016-07-01", "2016-07-03")
+    assert wf.station_daily([casey]).empty
+
+def test_station_daily_drops_partial_edge_days():
+    station = Station(1, 147.3, -42.9, "2016-07-01 10:00", "2016-07-04 10:00")
+    daily = wf.station_daily([station])
+    assert daily.index.get_level_values("date").tolist() == list(
+        pd.to_datetime(["2016-07-02", "2016-07-03"]))
+    station.start = station.end = None
+    assert len(wf.station_daily([station])) == 2
+
+def test_lookup(store):
+    store.update([Station(1, 147.3, -42.9, "2016-07-01", "2016-07-11")])
+    row = store.lookup(HOBART, "2016-07-05")
+    assert row.name == (HOBART.name, "2016-07-05")
+    assert row.obs_precip == pytest.approx(2.4)
+    assert row.obs_precip_lag1 == pytest.approx(2.4)
+    with pytest.raises(KeyError):
+        store.lookup(HOBART, "2016-08-01")
+    assert len(store.lookup_range(HOBART.name, "2016-07-02", "2016-07-05")) == 3
+
+def test_batch_keeps_order_and_fills_missing(store):
+    store.update([Station(1, 147.3, -42.9, "2016-07-01", "2016-07-11")])
+    keys = [(HOBART, "2016-07-03"), (LAUNCESTON, "2016-07-03"), (HOBART.name, "2016-07-01")]
+    result = store.batch(keys)
+    assert result.index.tolist() == [(HOBART.name, pd.Timestamp("2016-07-03")),
+                                     (LAUNCESTON.name, pd.Timestamp("2016-07-03")),
+                                     (HOBART.name, pd.Timestamp("2016-07-01"))]
+    assert result.loc[(LAUNCESTON.name, pd.Timestamp("2016-07-03"))].isna().all()
+    assert not np.isnan(result.obs_temp_mean.iloc[0])
+
+def test_update_merges_stations_of_a_catchment(store):
+    store.update([Station(1, 147.3, -42.9, "2016-07-01", "2016-07-11")])
+    store.update([Station(2, 147.4, -42.8, "2016-07-01", "2016-07-11", offset=2.0)])
+    first = Station(1, 147.3, -42.9, "2016-07-01", "2016-07-11")
+    expected = first.data.air_temp.resample("D").mean().iloc[0] + 1.0
+    assert store.lookup(HOBART, "2016-07-01").obs_temp_mean == pytest.approx(expected)
+
+def test_update_keeps_complete_days_over_partial_ones(store):
+    store.update([Station(1, 147.3, -42.9, "2016-07-01", "2016-07-11")])
+    before = store.lookup(HOBART, "2016-07-05")
+    store.update([Station(1, 147.3, -42.9, "2016-07-05 12:00", "2016-07-08")])
+    after = store.lookup(HOBART, "2016-07-05")
+    pd.testing.assert_series_equal(before, after)
+
+def test_incremental_updates_match_a_single_build(store):
+    store.update([Station(1, 147.3, -42.9, "2015-01-01", "2016-03-01")])
+    store.update([Station(1, 147.3, -42.9, "2016-03-01", "2016-04-01")])
+    incremental = store.lookup_range(HOBART)
+    #Only the new days and their lags were recomputed, which must agree with
+    #recomputing everything against the same models
+    with store.connection:
+        store._refresh(HOBART.name, None, None)
+    pd.testing.assert_frame_equal(incremental, store.lookup_range(HOBART))
+
+    whole = wf.FeatureStore(":memory:")
+    whole.update([Station(1, 147.3, -42.9, "2015-01-01", "2016-04-01")])
+    columns = wf.OBSERVED + [c for c in wf.LAGGED if c.startswith("obs_")]
+    pd.testing.assert_frame_equal(incremental[columns], whole.lookup_range(HOBART)[columns])
+
+def test_models_wait_for_history_and_are_retried(store):
+    #Rain only starts being reported half way through the first year
+    store.update([Station(1, 147.3, -42.9, "2015-01-01", "2015-07-01", precip=False)])
+    assert store._models(HOBART.name) == {}
+    store.update([Station(1, 147.3, -42.9, "2015-07-01", "2016-02-01")])
+    assert set(store._models(HOBART.name)) == {"temp_max", "temp_min", "temp_mean"}
+    assert np.isnan(store.lookup(HOBART, "2016-01-15").exp_precip)
+    store.update([Station(1, 147.3, -42.9, "2016-02-01", "2016-08-01")])
+    assert "precip" in store._models(HOBART.name)
+    assert not np.isnan(store.lookup(HOBART, "2015-08-01").exp_precip)
+
+def test_models_are_refitted_each_year(store):
+    store.update([Station(1, 147.3, -42.9, "2015-01-01", "2016-01-15")])
+    history = dict(store.connection.execute("SELECT variable, history FROM models"))
+    store.update([Station(1, 147.3, -42.9, "2016-01-15", "2016-06-01")])
+    assert dict(store.connection.execute("SELECT variable, history FROM models")) == history
+    store.update([Station(1, 147.3, -42.9, "2016-06-01", "2017-01-15")])
+    refitted = dict(store.connection.execute("SELECT variable, history FROM models"))
+    assert all(refitted[v] >= history[v] + wf.REFIT_EVERY_DAYS for v in history)
@@ -0,0 +1,124 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import weather_stations as ws
+
+
+def write_obs(path, rows):
+    pd.DataFrame(rows, columns=["station_number", "valid_start", "parameter", "value"]
+                 ).to_csv(path, index=False)
+
+def epoch(*args):
+    return pd.Timestamp(datetime(*args), tz=ws.TIMEZONE).timestamp()
+
+def make_release(root, name, files=("obs.csv",)):
+    obs = root / "bom" / name / "obs"
+    obs.mkdir(parents=True)
+    (root / "bom" / name / "spatial").mkdir()
+    for file in files:
+        write_obs(obs / file, [])
+    return obs
+
+
+def test_release_bounds_are_inclusive_days():
+    start, end = ws._release_bounds(r"data\bom\BoM_ETA_20160501-20170430\obs\x.csv")
+    assert (start, end) == (datetime(2016, 5, 1), datetime(2017, 5, 1))
+    assert ws._release_bounds("somewhere_else") == (None, None)
+
+def test_file_bounds_span_every_date_in_name():
+    assert ws._file_bounds("obs_20160601.csv") == (datetime(2016, 6, 1), datetime(2016, 6, 2))
+    assert ws._file_bounds("obs_20160601_20160603.csv") == (datetime(2016, 6, 1),
+                                                           datetime(2016, 6, 4))
+    #Not a valid date, and not an 8 digit run
+    assert ws._file_bounds("obs_20161399.csv") == (None, None)
+    assert ws._file_bounds("obs_123456789.csv") == (None, None)
+
+def test_catalogue_releases_does_not_walk_into_releases(tmp_path):
+    obs = make_release(tmp_path, "BoM_ETA_20160501-20170430")
+    (obs / "BoM_ETA_20200101-20201231" / "obs").mkdir(parents=True)
+    make_release(tmp_path, "BoM_ETA_20170501-20180430")
+    releases = ws.catalogue_releases(str(tmp_path))
+    assert releases.release.tolist() == ["BoM_ETA_20160501-20170430",
+                                         "BoM_ETA_20170501-20180430"]
+    assert all(folder.endswith("spatial") for folder in releases.spatial_dir)
+
+def test_catalogue_files_falls_back_to_release_bounds(tmp_path):
+    obs = make_release(tmp_path, "BoM_ETA_20160501-20170430",
+                       files=("obs_20160601.csv", "obs.csv"))
+    catalogue = ws.catalogue_files(str(obs))
+    catalogue.index = [name.split(os.sep)[-1] for name in catalogue.file]
+    assert catalogue.start["obs_20160601.csv"] == pd.Timestamp(2016, 6, 1)
+    assert catalogue.end["obs_20160601.csv"] == pd.Timestamp(2016, 6, 2)
+    assert catalogue.start["obs.csv"] == pd.Timestamp(2016, 5, 1)
+    assert catalogue.end["obs.csv"] == pd.Timestamp(2017, 5, 1)
+
+def test_catalogue_files_lists_every_folder(tmp_path):
+    first = make_release(tmp_path, "BoM_ETA_20160501-20170430")
+    second = make_release(tmp_path, "BoM_ETA_20170501-20180430")
+    assert len(ws.catalogue_files([str(first), str(second)])) == 2
+
+def test_catalogue_files_with_no_files(tmp_path):
+    with pytest.raises(ValueError, match="No data files found"):
+        ws.catalogue_files(str(tmp_path))
+
+def test_files_in_window_keeps_files_either_side_of_boundary():
+    catalogue = pd.DataFrame({
+        "file":  ["2016", "2017", "2018", "undated"],
+        "start": pd.to_datetime(["2016-05-01", "2017-05-01", "2018-05-01", None]),
+        "end":   pd.to_datetime(["2017-05-01", "2018-05-01", "2019-05-01", None]),
+        })
+    #The 2016 release may hold the first hours of the 1st of May if it is
+    #named by UTC day, so it is kept
+    assert ws.files_in_window(catalogue, "2017-05-01", "2017-06-01") == ["2016", "2017",
+                                                                         "undated"]
+    assert ws.files_in_window(catalogue, "2016-06-01", "2016-09-01") == ["2016", "undated"]
+    assert ws.files_in_window(catalogue) == catalogue.file.tolist()
+
+def test_get_station_data_filters_station_and_window(tmp_path):
+    file = tmp_path / "obs.csv"
+    write_obs(file, [
+        (1, epoch(2016, 6, 30, 23), "AIR_TEMP", 1.0),
+        (1, epoch(2016, 7, 1, 0), "AIR_TEMP", 2.0),
+        (1, epoch(2016, 7, 1, 6), "PRCP", 0.4),
+        (2, epoch(2016, 7, 1, 6), "AIR_TEMP", 9.0),
+        (1, epoch(2016, 7, 2, 0), "AIR_TEMP", 3.0),
+        ])
+    temp, prcp = ws.get_station_data_from_file(str(file), 1, "2016-07-01", "2016-07-02")
+    assert temp.value.tolist() == [2.0]
+    assert prcp.value.tolist() == [0.4]
+    assert str(temp.index.tz) == ws.TIMEZONE
+    assert temp.index[0] == pd.Timestamp("2016-07-01 00:00", tz=ws.TIMEZONE)
+
+def test_get_station_data_reads_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(ws, "CHUNKSIZE", 2)
+    file = tmp_path / "obs.csv"
+    write_obs(file, [(1, epoch(2016, 7, 1, h), "AIR_TEMP", float(h)) for h in range(5)])
+    temp, _ = ws.get_station_data_from_file(str(file), 1)
+    assert temp.value.tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+@pytest.mark.parametrize("contents", ["", "station_number,valid_start,parameter,value\n"])
+def test_get_station_data_from_empty_file(tmp_path, contents):
+    file = tmp_path / "obs.csv"
+    file.write_text(contents)
+    temp, prcp = ws.get_station_data_from_file(str(file), 1)
+    assert temp.empty and prcp.empty
+
+def test_read_stations_metadata_prefers_latest_release(tmp_path):
+    rows = []
+    for name, stations in (("BoM_ETA_20160501-20170430", [(1, "Old name"), (2, "Two")]),
+                           ("BoM_ETA_20170501-20180430", [(1, "New name"), (3, "Three")])):
+        make_release(tmp_path, name)
+        pd.DataFrame(stations, columns=["station_number", "station_name"]).to_csv(
+            tmp_path / "bom" / name / "spatial" / "StationData.csv", index=False)
+    metadata = ws.read_stations_metadata(ws.catalogue_releases(str(tmp_path)))
+    assert sorted(metadata.station_number) == [1, 2, 3]
+    assert metadata.set_index("station_number").station_name[1] == "New name"
+
+def test_legacy_cache_file_is_reported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ws.LEGACY_CACHE_FILE).write_bytes(b"")
+    with pytest.raises(FileNotFoundError, match="preprocess_and_cache_all_stations"):
+        ws.get_all_stations_from_file()
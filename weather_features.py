@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Staffing decisions are made per hospital, per day, so this is the shape the
+weather features need to be in. Rather than loading stations, working out
+catchments and refitting seasonal models every time a feature vector is
+wanted, the features are precomputed once into an SQLite table keyed by
+(hospital, date) and looked up from there.
+
+Each station within MAX_STATION_DISTANCE of a hospital is assigned to the
+nearest one. Daily summaries are stored per station, and the stations in a
+catchment are averaged. For each variable we store the observed value, the
+value expected from a seasonal model like the one in hobart_daily_temp.py
+(a linear trend plus a cosine peaking mid January), the anomaly
+(observed - expected), and lags of the observed value and anomaly.
+
+A seasonal model is only fitted once a variable has been observed across at
+least MIN_HISTORY_DAYS; until then its expected values and anomalies are
+left empty, and fitting is retried on each update. Models are refitted each
+time another REFIT_EVERY_DAYS of history accumulates, and only include the
+trend once MIN_TREND_DAYS are available, since a trend fitted to a single
+year mostly reflects that year's seasonal asymmetry.
+"""
+
+import sqlite3
+
+#Data handling
+import numpy as np
+import pandas as pd
+#Stats
+import statsmodels.formula.api as smf
+
+FEATURE_STORE_FILE = "hospital_weather_features.sqlite"
+
+VARIABLES = ("temp_max", "temp_min", "temp_mean", "precip")
+LAGS = (1, 2, 7)
+
+#Days are in Tasmanian local time, as for weather_stations.TIMEZONE
+TIMEZONE = "Australia/Hobart"
+
+#A seasonal model needs a full year of history spanned by at least this many
+#days of observations before it is trusted to extrapolate.
+MIN_HISTORY_DAYS = 365
+MIN_OBSERVED_DAYS = 180
+REFIT_EVERY_DAYS = 365
+MIN_TREND_DAYS = 3 * 365
+
+#Stations further than this (in degrees) from every hospital, e.g. the
+#Antarctic and sub-Antarctic stations in the TAS/ANT region, are ignored.
+MAX_STATION_DISTANCE = 2
+
+OBSERVED = [f"obs_{v}" for v in VARIABLES]
+EXPECTED = [f"exp_{v}" for v in VARIABLES]
+ANOMALY  = [f"anom_{v}" for v in VARIABLES]
+LAGGED   = [f"{kind}_{v}_lag{lag}" for kind in ("obs", "anom")
+            for v in VARIABLES for lag in LAGS]
+DERIVED  = EXPECTED + ANOMALY + LAGGED
+FEATURES = OBSERVED + DERIVED
+
+
+def _hospital_name(hospital):
+    #Accept either a Hospital object or its name
+    return getattr(hospital, "name", hospital)
+
+def _date_key(date):
+    return pd.Timestamp(date).strftime("%Y-%m-%d")
+
+def _design(dates, origin):
+    '''
+    The regressors of the seasonal model: time in years since origin, and
+    a yearly cosine peaking on the 15th of January.
+    '''
+    dates = pd.DatetimeIndex(dates)
+    return pd.DataFrame({"time": (dates - origin).days / 365.25,
+                         "season": np.cos(2 * np.pi * (dates.dayofyear - 15) / 365.25)},
+                        index=dates)
+
+def _complete_from(time):
+    #Whether a day starting at a window bound is wholly inside the window
+    if time is None:
+        return False
+    time = pd.Timestamp(time)
+    time = time.tz_localize(TIMEZONE) if time.tzinfo is None else time.tz_convert(TIMEZONE)
+    return time == time.normalize()
+
+def station_daily(stations):
+    '''
+    Summarise each station's data into one row per day, and assign the
+    station to the catchment of its nearest hospital.
+
+    A station's first and last days are dropped unless its start and end
+    fall on midnight, as otherwise they may only hold part of a day and
+    would overwrite a complete day already in the store.
+
+    Parameters
+    ----------
+    stations : iterable of weather_stations.Station
+        Stations further than MAX_STATION_DISTANCE from every hospital are
+        skipped.
+
+    Returns
+    -------
+    pd.DataFrame
+        A hospital column and the OBSERVED columns, indexed by
+        (station, date), where dates are days in TIMEZONE.
+
+    Raises
+    ------
+    ValueError
+        Raised if a station's data has a timezone-naive index, as stations
+        cached before times were localised do. Rebuild the cache with
+        weather_stations.preprocess_and_cache_all_stations.
+    '''
+    #Geocodes the hospitals on import, so only needed when building
+    from hospital_geospacial import get_nearest_hospital
+
+    frames = []
+    for station in stations:
+        data = station.data
+        if data.empty:
+            continue
+        if data.index.tz is None:
+            raise ValueError(f"Station {station.name} has timezone-naive data")
+        hospital = get_nearest_hospital(station.long, station.lat)
+        distance = np.hypot(hospital.long - station.long, hospital.lat - station.lat)
+        if distance > MAX_STATION_DISTANCE:
+            continue
+        data = data.tz_convert(TIMEZONE)
+        daily = pd.DataFrame({
+            "obs_temp_max":  data.air_temp.resample("D").max(),
+            "obs_temp_min":  data.air_temp.resample("D").min(),
+            "obs_temp_mean": data.air_temp.resample("D").mean(),
+            "obs_precip":    data.precipitation.resample("D").sum(min_count=1),
+            })
+        #The day buckets are already local, so drop the timezone from the key
+        daily.index = daily.index.tz_localize(None)
+        if not _complete_from(getattr(station, "start", None)):
+            daily = daily.iloc[1:]
+        if not _complete_from(getattr(station, "end", None)):
+            daily = daily.iloc[:-1]
+        daily.index = pd.MultiIndex.from_product([[station.station_id], daily.index],
+                                                 names=["station", "date"])
+        daily.insert(0, "hospital", hospital.name)
+        frames.append(daily)
+    if not frames:
+        index = pd.MultiIndex.from_tuples([], names=["station", "date"])
+        return pd.DataFrame(columns=["hospital"] + OBSERVED, index=index)
+    return pd.concat(frames)
+
+def fit_seasonal_model(observed, variable):
+    '''
+    Fit variable ~ time + season by OLS to one hospital's daily observations.
+
+    Parameters
+    ----------
+    observed : pd.DataFrame
+        OBSERVED columns for a single hospital, indexed by date.
+    variable : str
+        One of VARIABLES.
+
+    Returns
+    -------
+    (origin, params) or None
+        origin is the date at which time = 0, and params the fitted
+        coefficients, indexed by Intercept, time and season. The time
+        coefficient is 0 if the observations span fewer than MIN_TREND_DAYS.
+        None if they span fewer than MIN_HISTORY_DAYS or number fewer than
+        MIN_OBSERVED_DAYS, e.g. if no station in the catchment reports it.
+
+    '''
+    y = observed[f"obs_{variable}"].dropna()
+    if len(y) < MIN_OBSERVED_DAYS:
+        return None
+    span = (y.index.max() - y.index.min()).days + 1
+    if span < MIN_HISTORY_DAYS:
+        return None
+    origin = y.index.min()
+    data = _design(y.index, origin)
+    data["y"] = y.to_numpy()
+    formula = "y ~ time + season" if span >= MIN_TREND_DAYS else "y ~ season"
+    result = smf.ols(formula=formula, data=data).fit()
+    return origin, result.params.reindex(["Intercept", "time", "season"], fill_value=0.0)
+
+def derive_features(observed, models):
+    '''
+    Compute the expected values, anomalies and lags for one hospital.
+
+    Parameters
+    ----------
+    observed : pd.DataFrame
+        OBSERVED columns for a single hospital, indexed by date. Lags are
+        taken over calendar days, so rows are added for any missing dates.
+    models : dict
+        Maps variables to the (origin, params) of their seasonal model, as
+        returned by fit_seasonal_model. Variables without a model get NaN
+        expected values and anomalies.
+
+    Returns
+    -------
+    pd.DataFrame
+        The DERIVED columns, indexed by date.
+
+    '''
+    observed = observed.asfreq("D")
+    derived = pd.DataFrame(index=observed.index)
+    for variable in VARIABLES:
+        if variable in models:
+            origin, params = models[variable]
+            x = _design(observed.index, origin)
+            derived[f"exp_{variable}"] = (params["Intercept"] + params["time"] * x.time
+                                          + params["season"] * x.season)
+        else:
+            derived[f"exp_{variable}"] = np.nan
+        derived[f"anom_{variable}"] = (observed[f"obs_{variable}"]
+                                       - derived[f"exp_{variable}"])
+    for kind in ("obs", "anom"):
+        for variable in VARIABLES:
+            source = (observed if kind == "obs" else derived)[f"{kind}_{variable}"]
+            for lag in LAGS:
+                derived[f"{kind}_{variable}_lag{lag}"] = source.shift(lag)
+    return derived[DERIVED]
+
+
+class FeatureStore:
+    def __init__(self, path=FEATURE_STORE_FILE):
+        '''
+        An on-disk table of daily weather features for each hospital.
+
+        >>store = FeatureStore()
+        #Populate (or refresh) the store from station data
+        >>store.update(stations)
+        #Pull features for the scheduler
+        >>store.lookup(rhh, "2016-07-01")
+        >>store.lookup_range(rhh, "2016-06-01", "2016-09-01")
+        >>store.batch([(rhh, "2016-07-01"), (lgh, "2016-07-02")])
+
+        Parameters
+        ----------
+        path : str, optional
+            The SQLite database to use, created if it doesn't exist.
+            The default is FEATURE_STORE_FILE.
+
+        '''
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        columns = ", ".join(f"{c} REAL" for c in FEATURES)
+        with self.connection:
+            #WITHOUT ROWID stores rows in (hospital, date) order, so a range
+            #of dates for one hospital is a single contiguous read.
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS features (hospital TEXT, date TEXT, "
+                f"{columns}, PRIMARY KEY (hospital, date)) WITHOUT ROWID")
+            #Daily summaries per station, from which the catchment means in
+            #features are recomputed, so updates merge with stored data
+            station_columns = ", ".join(f"{c} REAL" for c in OBSERVED)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS station_days (station INTEGER, date TEXT, "
+                f"hospital TEXT, {station_columns}, PRIMARY KEY (station, date)) "
+                f"WITHOUT ROWID")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS station_days_by_hospital "
+                "ON station_days (hospital, date)")
+            #history is the span in days of the variable's observations when
+            #its model was fitted. Variables without a model have no row.
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS models (hospital TEXT, variable TEXT, "
+                "history INTEGER, origin TEXT, intercept REAL, time REAL, season REAL, "
+                "PRIMARY KEY (hospital, variable))")
+
+    def update(self, stations, refit=False):
+        '''
+        Add new station data to the store. The data is merged with what is
+        already stored: catchment means are recomputed from every station
+        stored for the affected days, not just the ones passed in. Only
+        those days, and the following max(LAGS) days whose lags refer to
+        them, are recomputed, unless a seasonal model was (re)fitted, in
+        which case all of that hospital's rows are.
+
+        Parameters
+        ----------
+        stations : iterable of weather_stations.Station
+            See station_daily.
+        refit : bool, optional
+            Whether to refit every seasonal model that can be fitted, rather
+            than only those that are due. The default is False.
+
+        '''
+        daily = station_daily(stations)
+        with self.connection:
+            self._write_station_days(daily)
+            for hospital, rows in daily.groupby("hospital"):
+                dates = rows.index.get_level_values("date")
+                first, last = dates.min(), dates.max()
+                self._write_observed(hospital, first, last)
+                if self._fit_models(hospital, refit):
+                    start, end = None, None
+                else:
+                    start, end = first, last + pd.Timedelta(days=max(LAGS))
+                self._refresh(hospital, start, end)
+
+    def lookup(self, hospital, date):
+        '''
+        Features for a single hospital-day.
+
+        Raises
+        ------
+        KeyError
+            Raised if the store has no row for that hospital-day.
+        '''
+        key = (_hospital_name(hospital), _date_key(date))
+        row = self.connection.execute(
+            f"SELECT {', '.join(FEATURES)} FROM features WHERE hospital = ? AND date = ?",
+            key).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pd.Series(row, index=FEATURES, name=key, dtype=float)
+
+    def lookup_range(self, hospital, start=None, end=None):
+        '''
+        Features for one hospital over [start, end), indexed by date.
+        Either bound may be None to leave that side of the range open.
+        '''
+        return self._read(_hospital_name(hospital), start, end, FEATURES, inclusive=False)
+
+    def batch(self, keys):
+        '''
+        Features for many (hospital, date) pairs at once, indexed by
+        (hospital, date) in the order given. Pairs missing from the store
+        get a row of NaN.
+        '''
+        keys = [(_hospital_name(h), _date_key(d)) for h, d in keys]
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS batch_keys (hospital TEXT, date TEXT)")
+            self.connection.execute("DELETE FROM batch_keys")
+            self.connection.executemany("INSERT INTO batch_keys VALUES (?, ?)", keys)
+            columns = ", ".join(f"f.{c}" for c in FEATURES)
+            result = pd.read_sql_query(
+                f"SELECT k.hospital, k.date, {columns} FROM batch_keys k "
+                f"LEFT JOIN features f ON f.hospital = k.hospital AND f.date = k.date "
+                f"ORDER BY k.rowid", self.connection, parse_dates=["date"])
+        return result.set_index(["hospital", "date"]).astype(float)
+
+    def hospitals(self):
+        return [row[0] for row in
+                self.connection.execute("SELECT DISTINCT hospital FROM features")]
+
+    def close(self):
+        self.connection.close()
+
+    def _read(self, hospital, start, end, columns, inclusive=True):
+        query = f"SELECT date, {', '.join(columns)} FROM features WHERE hospital = ?"
+        params = [hospital]
+        if start is not None:
+            query += " AND date >= ?"
+            params.append(_date_key(start))
+        if end is not None:
+            query += " AND date <= ?" if inclusive else " AND date < ?"
+            params.append(_date_key(end))
+        result = pd.read_sql_query(query + " ORDER BY date", self.connection,
+                                   params=params, index_col="date",
+                                   parse_dates=["date"])
+        return result.astype(float)
+
+    def _write_station_days(self, daily):
+        assignments = ", ".join(f"{c} = excluded.{c}" for c in ["hospital"] + OBSERVED)
+        rows = [(int(station), _date_key(date), values[0],
+                 *(None if pd.isna(v) else float(v) for v in values[1:]))
+                for (station, date), values in zip(daily.index, daily.to_numpy())]
+        self.connection.executemany(
+            f"INSERT INTO station_days (station, date, hospital, {', '.join(OBSERVED)}) "
+            f"VALUES ({', '.join(['?'] * (3 + len(OBSERVED)))}) "
+            f"ON CONFLICT (station, date) DO UPDATE SET {assignments}", rows)
+
+    def _write_observed(self, hospital, first, last):
+        #Catchment means over every stored station, for the days in [first, last]
+        means = ", ".join(f"AVG({c})" for c in OBSERVED)
+        assignments = ", ".join(f"{c} = excluded.{c}" for c in OBSERVED)
+        self.connection.execute(
+            f"INSERT INTO features (hospital, date, {', '.join(OBSERVED)}) "
+            f"SELECT hospital, date, {means} FROM station_days "
+            f"WHERE hospital = ? AND date >= ? AND date <= ? GROUP BY date "
+            f"ON CONFLICT (hospital, date) DO UPDATE SET {assignments}",
+            (hospital, _date_key(first), _date_key(last)))
+
+    def _span(self, hospital, variable):
+        #(days observed, days spanned) by one variable's stored observations
+        count, first, last = self.connection.execute(
+            f"SELECT COUNT(*), MIN(date), MAX(date) FROM features "
+            f"WHERE hospital = ? AND obs_{variable} IS NOT NULL", (hospital,)).fetchone()
+        if not count:
+            return 0, 0
+        return count, (pd.Timestamp(last) - pd.Timestamp(first)).days + 1
+
+    def _fit_models(self, hospital, refit=False):
+        '''
+        Fit the seasonal models that are due: those not yet fitted, those
+        whose history has grown by REFIT_EVERY_DAYS since they were fitted,
+        or all of them if refit is True. Variables without enough history are
+        left without a model. Returns whether any model was (re)fitted.
+        '''
+        fitted = dict(self.connection.execute(
+            "SELECT variable, history FROM models WHERE hospital = ?", (hospital,)))
+        due = {}
+        for variable in VARIABLES:
+            count, span = self._span(hospital, variable)
+            if count < MIN_OBSERVED_DAYS or span < MIN_HISTORY_DAYS:
+                continue
+            if refit or variable not in fitted or span >= fitted[variable] + REFIT_EVERY_DAYS:
+                due[variable] = span
+        if not due:
+            return False
+        observed = self._read(hospital, None, None, OBSERVED)
+        rows = []
+        for variable, span in due.items():
+            origin, params = fit_seasonal_model(observed, variable)
+            rows.append((hospital, variable, span, _date_key(origin),
+                         params["Intercept"], params["time"], params["season"]))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return True
+
+    def _models(self, hospital):
+        rows = self.connection.execute(
+            "SELECT variable, origin, intercept, time, season FROM models "
+            "WHERE hospital = ?", (hospital,))
+        return {variable: (pd.Timestamp(origin),
+                           pd.Series({"Intercept": intercept, "time": time,
+                                      "season": season}))
+                for variable, origin, intercept, time, season in rows}
+
+    def _refresh(self, hospital, start, end):
+        #Lags for the first rows in the range need observations from before it
+        lookback = None if start is None else start - pd.Timedelta(days=max(LAGS))
+        observed = self._read(hospital, lookback, end, OBSERVED)
+        if observed.empty:
+            return
+        derived = derive_features(observed, self._models(hospital))
+        if start is not None:
+            derived = derived[derived.index >= start]
+        assignments = ", ".join(f"{c} = ?" for c in DERIVED)
+        rows = [(*(None if pd.isna(v) else float(v) for v in values), hospital, _date_key(date))
+                for date, values in zip(derived.index, derived.to_numpy())]
+        #Dates filled in by derive_features have no row, so are left out
+        self.connection.executemany(
+            f"UPDATE features SET {assignments} WHERE hospital = ? AND date = ?", rows)
+
+    def __repr__(self):
+        return f"FeatureStore object||{self.path}"
+
+
+if __name__ == "__main__":
+    #Build the store from the cached Tasmanian stations, then show the
+    #features for the first hospital
+    from hospital_geospacial import HOSPITALS
+    from weather_stations import get_all_stations_from_file
+    store = FeatureStore()
+    store.update(get_all_stations_from_file(), refit=True)
+    print(store.lookup_range(HOSPITALS[0]))
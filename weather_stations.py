@@ -6,8 +6,9 @@ Created on Tue Apr 12 17:22:11 2022
 """
 
 import os
+import re
 import pickle as pkl
-from datetime import datetime
+from datetime import datetime, timedelta
 
 #Data handling
 import pandas as pd
@@ -16,53 +17,279 @@ import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 import seaborn as sns
 
-#Local
-import census_and_geography as geom
-
 sns.set_style("darkgrid")
 sns.set_context("paper")
 
+BOM_DATA_ROOT = "data"
+
 dat_2016_2017 = r"data\bom2016_2017\BoM_ETA_20160501-20170430\obs"
 
-STATIONS_METADATA_SOURCE = r"data\bom2016_2017\BoM_ETA_20160501-20170430\spatial\StationData.csv"
+#Each BoM ETA release lives in a folder named for the (inclusive) period it
+#covers, e.g. BoM_ETA_20160501-20170430, with its CSVs in an obs subfolder
+#and its station list in spatial\StationData.csv.
+RELEASE_PATTERN = re.compile(r"BoM_ETA_(\d{8})-(\d{8})")
+DATE_PATTERN = re.compile(r"(?<!\d)(\d{8})(?!\d)")
+
+#Observations are bucketed into days by Tasmanian local time, whatever the
+#timezone of the machine doing the processing.
+TIMEZONE = "Australia/Hobart"
+
+#How far file bounds from names are widened when deciding what to open
+CATALOGUE_SLACK = pd.Timedelta(days=1)
+
+#Rows read per chunk when filtering a CSV down to one station and window
+CHUNKSIZE = 500_000
+
+
+def _parse_date(yyyymmdd):
+    try:
+        return datetime.strptime(yyyymmdd, "%Y%m%d")
+    except ValueError:
+        return None
+
+def _bounds_from_dates(dates):
+    #Dates in names are inclusive days, so the end bound is the day after
+    #the last date. (None, None) if there are no usable dates.
+    dates = [d for d in (_parse_date(d) for d in dates) if d is not None]
+    if not dates:
+        return None, None
+    return min(dates), max(dates) + timedelta(days=1)
+
+def _release_bounds(path):
+    '''
+    Recover the [start, end) period of the release folder named in path,
+    e.g. BoM_ETA_20160501-20170430.
+    '''
+    match = RELEASE_PATTERN.search(path)
+    return _bounds_from_dates(match.groups() if match else [])
+
+def _file_bounds(filename):
+    '''
+    Recover the [start, end) period spanned by any YYYYMMDD dates in a
+    file name.
+    '''
+    return _bounds_from_dates(DATE_PATTERN.findall(filename))
+
+def catalogue_releases(root=BOM_DATA_ROOT):
+    '''
+    Find every BoM ETA release beneath root.
+
+    Parameters
+    ----------
+    root : str, optional
+        Directory to search. The default is BOM_DATA_ROOT.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per release, with columns release (the folder name),
+        obs_dir (the folder holding its CSVs), spatial_dir (the folder
+        holding its station metadata), start and end (the [start, end)
+        period covered). Sorted by start.
+
+    '''
+    rows = []
+    for dirpath, dirnames, _ in os.walk(root):
+        unmatched = []
+        for dirname in dirnames:
+            start, end = _release_bounds(dirname)
+            if start is None:
+                unmatched.append(dirname)
+                continue
+            obs_dir = os.path.join(dirpath, dirname, "obs")
+            spatial_dir = os.path.join(dirpath, dirname, "spatial")
+            if os.path.isdir(obs_dir):
+                rows.append((dirname, obs_dir, spatial_dir, start, end))
+        #Don't walk into releases, whose obs folders hold thousands of CSVs
+        dirnames[:] = unmatched
+    releases = pd.DataFrame(rows, columns=["release", "obs_dir", "spatial_dir",
+                                           "start", "end"])
+    return releases.sort_values("start", ignore_index=True)
+
+def read_stations_metadata(releases):
+    '''
+    Combine the StationData.csv of every release into one table of station
+    metadata. Stations listed by several releases are described by the
+    latest of them.
+
+    Parameters
+    ----------
+    releases : pd.DataFrame
+        As returned by catalogue_releases().
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per station_number.
 
-STATIONS_METADATA = pd.read_csv(STATIONS_METADATA_SOURCE)
+    '''
+    sources = [os.path.join(folder, "StationData.csv") for folder in releases.spatial_dir]
+    frames = [pd.read_csv(source) for source in sources if os.path.isfile(source)]
+    if not frames:
+        return pd.DataFrame(columns=["station_number", "station_name", "LONGITUDE",
+                                     "LATITUDE", "REGION", "STN_HT"])
+    metadata = pd.concat(frames, ignore_index=True)
+    return metadata.drop_duplicates("station_number", keep="last", ignore_index=True)
 
+def catalogue_files(data_source=None):
+    '''
+    List the CSV files in a data source along with the period each covers.
+    Nothing is opened; bounds come from the file name if it contains a date,
+    otherwise from the release folder it sits in. Files whose period can't
+    be determined get NaT bounds and are always considered in range.
 
-def get_station_data_from_file(file, station_id):
-    df = pd.read_csv(file)
-    dat = df[df.station_number == station_id]
+    Parameters
+    ----------
+    data_source : str, list of str, or pd.DataFrame, optional
+        A CSV, a directory containing CSVs, a list of such directories, or
+        an existing catalogue (returned unchanged). If None, every release
+        found by catalogue_releases() is used.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per file, with columns file, start and end.
+
+    '''
+    if isinstance(data_source, pd.DataFrame):
+        return data_source
+    if data_source is None:
+        data_source = catalogue_releases().obs_dir.tolist()
+        if not data_source:
+            raise ValueError(f"No BoM ETA releases found under {BOM_DATA_ROOT}")
+    #Our data source is either a CSV, a directory containing CSVs,
+    #or a list of directories that each contain CSVs.
+    if isinstance(data_source, list):
+        #Everything in the list must be a directory
+        if not all(os.path.isdir(folder) for folder in data_source):
+            raise ValueError("Every element of a data_source list must be a directory")
+        folders = data_source
+        all_files = []
+    elif data_source[-4:]==".csv":
+        folders = []
+        all_files = [data_source]
+    elif os.path.isdir(data_source):
+        folders = [data_source]
+        all_files = []
+    else:
+        raise ValueError("data_source must be csv, dir, or lst of dir")
+    for folder in folders:
+        files = sorted(f for f in os.listdir(folder) if f[-4:]==".csv")
+        all_files.extend(os.path.join(folder, f) for f in files)
+    if not all_files:
+        raise ValueError(f"No data files found under {data_source}")
+
+    rows = []
+    for file in all_files:
+        start, end = _file_bounds(os.path.basename(file))
+        if start is None:
+            start, end = _release_bounds(os.path.abspath(file))
+        rows.append((file, start, end))
+    catalogue = pd.DataFrame(rows, columns=["file", "start", "end"])
+    catalogue["start"] = pd.to_datetime(catalogue.start)
+    catalogue["end"] = pd.to_datetime(catalogue.end)
+    return catalogue
+
+def files_in_window(catalogue, start=None, end=None):
+    '''
+    Return the files of a catalogue whose period overlaps [start, end).
+    Either bound may be None to leave that side of the window open.
+    '''
+    #Catalogue bounds are naive dates, and nothing says whether BoM names
+    #releases by UTC or local days. Widen them by a day so no file holding
+    #rows in the window is skipped; rows are filtered exactly when read.
+    keep = pd.Series(True, index=catalogue.index)
+    if start is not None:
+        start = _to_local(start).tz_localize(None)
+        keep &= catalogue.end.isna() | (catalogue.end + CATALOGUE_SLACK > start)
+    if end is not None:
+        end = _to_local(end).tz_localize(None)
+        keep &= catalogue.start.isna() | (catalogue.start - CATALOGUE_SLACK < end)
+    return catalogue.file[keep].tolist()
+
+def _to_local(time):
+    #Naive times are taken to already be in TIMEZONE
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        return time.tz_localize(TIMEZONE)
+    return time.tz_convert(TIMEZONE)
+
+def _to_epoch(time):
+    if time is None:
+        return None
+    return _to_local(time).timestamp()
+
+def _to_index(valid_start):
+    return pd.to_datetime(valid_start.to_numpy(), unit="s", utc=True).tz_convert(TIMEZONE)
+
+STATIONS_METADATA = read_stations_metadata(catalogue_releases())
+
+#Written by versions that only read the 2016-17 release, with naive times
+LEGACY_CACHE_FILE = "2016_2017_all_tas_stations.pkl"
+
+def _cache_file_name(start=None, end=None):
+    #e.g. all_tas_stations_20160601-20160901.pkl for a single winter
+    if start is None and end is None:
+        return "all_tas_stations.pkl"
+    bounds = ["" if t is None else pd.Timestamp(t).strftime("%Y%m%d") for t in (start, end)]
+    return f"all_tas_stations_{bounds[0]}-{bounds[1]}.pkl"
+
+def get_station_data_from_file(file, station_id, start=None, end=None):
+    #Read in chunks so rows for other stations, or outside [start, end),
+    #are dropped before the whole file is held in memory.
+    start, end = _to_epoch(start), _to_epoch(end)
+    chunks = []
+    try:
+        reader = pd.read_csv(file, chunksize=CHUNKSIZE)
+    except pd.errors.EmptyDataError:
+        reader = []
+    for chunk in reader:
+        keep = chunk.station_number == station_id
+        if start is not None:
+            keep &= chunk.valid_start >= start
+        if end is not None:
+            keep &= chunk.valid_start < end
+        chunks.append(chunk[keep])
+    if not chunks:
+        #Header-only or empty file
+        empty = pd.DataFrame(columns=["value"], index=pd.DatetimeIndex([], tz=TIMEZONE))
+        return empty, empty
+    dat = pd.concat(chunks)
     temp = dat[dat.parameter == 'AIR_TEMP']
-    temp.index = [datetime.fromtimestamp(i) for i in temp["valid_start"]]
+    temp.index = _to_index(temp["valid_start"])
     prcp = dat[dat.parameter == 'PRCP']
-    prcp.index = [datetime.fromtimestamp(i) for i in prcp["valid_start"]]
+    prcp.index = _to_index(prcp["valid_start"])
     return temp,prcp
 
 class Station:
-    def __init__(self,data_source, station_id):
-        #Our data source is either a CSV, a directory containing CSVs,
-        #or a list of directories that each contain CSVs.
-        if data_source[-4:]==".csv":
-            all_files = data_source
-        elif os.path.isdir(data_source):
-            all_files = [file for file in os.listdir(data_source) if file[-4:]==".csv"]
-            all_files = [os.path.join(data_source,file) for file in all_files]
-        elif type(data_source)==list:
-            #Everything in the list must be a directory
-            assert(all((os.path.isdir(folder) for folder in data_source)))
-            folders = (os.listdir(folder) for folder in data_source)
-            all_files = []
-            for folder in folders:
-                files = [f for f in folder if f[-3:]=="csv"]
-                files = [os.path.join(folder,file) for file in files]
-                all_files.extend(files)
-        else:
-            raise ValueError("data_source for Station object must be csv, dir, or lst of dir")
+    def __init__(self,data_source, station_id, start=None, end=None):
+        '''
+        Weather data (air temperature and precipitation) for a single
+        BoM station.
+
+        Parameters
+        ----------
+        data_source : str, list of str, or pd.DataFrame
+            A CSV, a directory containing CSVs, a list of directories that
+            each contain CSVs, or a catalogue from catalogue_files().
+        station_id : int
+            The BoM station number.
+        start, end : datetime-like, optional
+            Only keep observations in [start, end). Naive times are taken
+            to be in TIMEZONE. Files whose period lies
+            entirely outside the window are never opened. The default is
+            to keep everything.
+
+        '''
+        all_files = files_in_window(catalogue_files(data_source), start, end)
+        if not all_files:
+            raise ValueError("No data files overlap the requested period")
+        self.start, self.end = start, end
         
         #Get temperature and precipitation data for this station from each file
         tmps, prcps = [], []
         for file in all_files:
-            tmp, prcp = get_station_data_from_file(file, station_id)
+            tmp, prcp = get_station_data_from_file(file, station_id, start, end)
             tmps.append(tmp); prcps.append(prcp)
         air_temp, precip = pd.concat(tmps), pd.concat(prcps)
         
@@ -72,7 +299,8 @@ class Station:
         precip = precip[["value"]]
         precip.columns = ["precipitation"]
         
-        #This has 2 columns, air_temp and precipitation, and is indexed by datetimes
+        #This has 2 columns, air_temp and precipitation, and is indexed by
+        #datetimes in TIMEZONE
         self.data = air_temp.join(precip)
         
         #Access and store the remaining station metadata, e.g. location
@@ -83,7 +311,9 @@ class Station:
                          float(row.LATITUDE), row.REGION.item(), 
                          float(row.STN_HT))
         
-        #Assign a color based on longitude + lattitude
+        #Assign a color based on longitude + lattitude. census_and_geography
+        #reads the census shapefile on import, so only pull it in when needed.
+        import census_and_geography as geom
         self.color = geom.color_from_loc(self.long, self.lat)
     
     def glance_at(self):
@@ -98,6 +328,7 @@ class Station:
             The created figure instance, which is also stored in self.fig.
 
         '''
+        import census_and_geography as geom
         fig = plt.figure(tight_layout = True, figsize = (12,6))
         gridspec = GridSpec(2,4,fig)
         ax1 = fig.add_subplot(gridspec[0,0:-1])
@@ -187,17 +418,29 @@ class Station:
         return self.name
 
 
-def preprocess_and_cache_all_stations(data_source, dst="2016_2017_all_tas_stations.pkl"):
+def preprocess_and_cache_all_stations(data_source=None, dst=None, start=None, end=None):
+    if dst is None:
+        dst = _cache_file_name(start, end)
+    #Catalogue once up front rather than re-listing directories per station
+    catalogue = catalogue_files(data_source)
     all_tasmanian_stations = []
     for idx, station in STATIONS_METADATA.iterrows():
         if station.REGION == "TAS/ANT":
             print(f"Reading data for station: {station.station_name}")
-            all_tasmanian_stations.append(Station(data_source,station.station_number))
+            all_tasmanian_stations.append(Station(catalogue,station.station_number,
+                                                  start, end))
 
     with open(dst, 'wb') as file:
         pkl.dump(all_tasmanian_stations, file)
 
-def get_all_stations_from_file(cache_file = "2016_2017_all_tas_stations.pkl"):
+def get_all_stations_from_file(cache_file = None, start=None, end=None):
+    if cache_file is None:
+        cache_file = _cache_file_name(start, end)
+        if not os.path.exists(cache_file) and os.path.exists(LEGACY_CACHE_FILE):
+            raise FileNotFoundError(
+                f"{cache_file} not found. {LEGACY_CACHE_FILE} was written by an "
+                f"older version of this module and can't be used; rebuild it with "
+                f"preprocess_and_cache_all_stations(), which now writes {cache_file}")
     with open(cache_file, 'rb') as file:
         all_tasmanian_stations = pkl.load(file)
     return all_tasmanian_stations